@@ -0,0 +1,76 @@
+#cython: language_level=3
+"""Optional C accelerator for the PBO header parser.
+
+Drop-in replacement for a3lib._parse_pbo_header; a3lib picks it up
+automatically when the compiled module is importable. Build in place
+with:
+
+    cythonize -i _pbo_c.pyx
+"""
+from libc.string cimport memchr, memcpy
+from libc.stdint cimport uint32_t
+
+
+def parse_pbo_header(object buf):
+    """Parse the PBO header from a contiguous buffer.
+
+    return tuple of header, extension items, file entries, data offset.
+    """
+    cdef const unsigned char[::1] view = memoryview(buf)
+    if view.shape[0] == 0:
+        raise ValueError("truncated PBO header")
+    cdef const char *base = <const char *> &view[0]
+    cdef Py_ssize_t size = view.shape[0]
+    cdef const char *p = base
+    cdef const char *end = base + size
+    cdef const char *q
+    #PBO entry fields are little-endian uint32; matches the host order
+    #on every platform this runs on
+    cdef uint32_t fields[5]
+
+    q = <const char *> memchr(p, 0, end - p)
+    if q == NULL:
+        raise ValueError("unterminated string in PBO header")
+    name = p[:q - p]
+    if end - q - 1 < 20:
+        raise ValueError("truncated PBO header")
+    memcpy(fields, q + 1, 20)
+    header = (name, fields[0], fields[1], fields[2], fields[3], fields[4])
+    p = q + 21
+
+    ext_items = []
+    while True:
+        q = <const char *> memchr(p, 0, end - p)
+        if q == NULL:
+            raise ValueError("unterminated string in PBO header")
+        s = p[:q - p]
+        p = q + 1
+        if len(s) == 0:
+            break
+        q = <const char *> memchr(p, 0, end - p)
+        if q == NULL:
+            raise ValueError("unterminated string in PBO header")
+        ext_items.append((s, p[:q - p]))
+        p = q + 1
+
+    entries = []
+    while True:
+        q = <const char *> memchr(p, 0, end - p)
+        if q == NULL:
+            raise ValueError("unterminated string in PBO header")
+        s = p[:q - p]
+        p = q + 1
+        if len(s) == 0:
+            break
+        if end - p < 20:
+            raise ValueError("truncated PBO header")
+        memcpy(fields, p, 20)
+        entries.append((s, fields[0], fields[1], fields[2], fields[3],
+                        fields[4]))
+        p += 20
+
+    #skip the empty 20-byte block terminating the header
+    if end - p < 20:
+        raise ValueError("truncated PBO header")
+    p += 20
+    return header, ext_items, entries, p - base
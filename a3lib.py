@@ -1,7 +1,12 @@
 import argparse
+import concurrent.futures
+import functools
 import hashlib
+import mmap
+import re
 import struct
 import sys
+import threading
 import os
 import base64
 import shutil
@@ -12,71 +17,132 @@ from collections import OrderedDict
 if sys.version > '3':
     long = int
 
+try:
+    from gmpy2 import mpz, powmod
+except ImportError:
+    mpz = long
+    powmod = pow
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 verbose = 0
 quiet = False
-CHUNK_SIZE = 4096
+CHUNK_SIZE = 1 << 20
 
 def unpack_asciiz(file):
     """Unpack a null-terminated string from file object."""
-    string = b''
-    byte = file.read(1)
-    while byte != b'\0':
-        string += byte
-        byte = file.read(1)
-    return string
-
-def padding(hash_value, tlen):
-    """Add padding to the hash value and return as long."""
-    return long('0x0001' + 'ff'*(tlen - len(hash_value)//2 - 3 - 15) + '00' +
-                '3021300906052b0e03021a05000414' + hash_value, 16)
+    string = bytearray()
+    chunk = file.read(256)
+    while chunk:
+        i = chunk.find(b'\0')
+        if i >= 0:
+            string += chunk[:i]
+            file.seek(i + 1 - len(chunk), 1)
+            break
+        string += chunk
+        chunk = file.read(256)
+    return bytes(string)
+
+#SHA-1 DigestInfo header for EMSA-PKCS1-v1_5
+_SHA1_DIGESTINFO = bytes.fromhex('3021300906052b0e03021a05000414')
+
+#PBO header/file entry: five little-endian uint32 fields
+_PBO_ENTRY = struct.Struct('<IIIII')
+_U32 = struct.Struct('<I')
+_U32X2 = struct.Struct('<II')
+#bikey blob header: length, type, version, 2 pad bytes, ALG_ID
+_BIKEY_HDR = struct.Struct('<IBB2xI')
+
+#extensions excluded from the version 2 file hash
+NO_HASH_EXT_V2 = frozenset((b'.paa', b'.jpg', b'.p3d', b'.tga', b'.rvmat',
+                            b'.lip', b'.ogg', b'.wss', b'.png', b'.rtm',
+                            b'.pac', b'.fxy', b'.wrp'))
+#extensions included in the version 3 file hash
+HASH_EXT_V3 = frozenset((b'.sqf', b'.inc', b'.bikb', b'.ext', b'.fsm',
+                         b'.sqm', b'.hpp', b'.cfg', b'.sqs', b'.h'))
+
+def padding(digest, tlen):
+    """Add padding to the hash digest and return as long."""
+    pad_len = tlen - len(digest) - len(_SHA1_DIGESTINFO) - 3
+    return int.from_bytes(b'\x00\x01' + b'\xff'*pad_len + b'\x00' +
+                          _SHA1_DIGESTINFO + digest, 'big')
 
 def int_to_bytes(n, length, endian='little'):
-    """Convert integer to tuple of bytes."""
-    if sys.version > '3':
-        return n.to_bytes(length, endian)
-    else:
-        s = '{:x}'.format(n)
-        if len(s) > 2*length:
-            raise OverflowError('int too big to convert')
-        b = bytearray.fromhex(s.zfill(2*length))
-        if endian == 'little':
-            b.reverse()
-        return tuple(b)
+    """Convert integer to bytes."""
+    return n.to_bytes(length, endian)
 
 def bytes_to_int(b, endian='little'):
-    """Convert tuple of bytes to integer."""
-    if sys.version > '3':
-        return int.from_bytes(b, endian)
-    else:
-        if endian == 'little':
-            byte_tuple = reversed(b)
-        else:
-            byte_tuple = b
-        s = '0x' + ''.join('{:02x}'.format(x) for x in byte_tuple)
-        return long(s, 16)
+    """Convert bytes to integer."""
+    return int.from_bytes(b, endian)
+
+def _parse_pbo_header(buf):
+    """Parse the PBO header from a contiguous buffer.
+
+    return tuple of header, extension items, file entries, data offset.
+    """
+    end = buf.find(b'\0')
+    if end < 0:
+        raise ValueError("unterminated string in PBO header")
+    header = (buf[:end],) + _PBO_ENTRY.unpack_from(buf, end + 1)
+    pos = end + 1 + _PBO_ENTRY.size
+    ext_items = []
+    while True:
+        end = buf.find(b'\0', pos)
+        if end < 0:
+            raise ValueError("unterminated string in PBO header")
+        s = buf[pos:end]
+        pos = end + 1
+        if len(s) == 0:
+            break
+        end = buf.find(b'\0', pos)
+        if end < 0:
+            raise ValueError("unterminated string in PBO header")
+        ext_items.append((s, buf[pos:end]))
+        pos = end + 1
+    entries = []
+    while True:
+        end = buf.find(b'\0', pos)
+        if end < 0:
+            raise ValueError("unterminated string in PBO header")
+        s = buf[pos:end]
+        pos = end + 1
+        if len(s) == 0:
+            break
+        entries.append((s,) + _PBO_ENTRY.unpack_from(buf, pos))
+        pos += _PBO_ENTRY.size
+    #skip the empty 20-byte block terminating the header
+    pos += 20
+    return header, ext_items, entries, pos
+
+try:
+    from _pbo_c import parse_pbo_header
+except ImportError:
+    parse_pbo_header = _parse_pbo_header
 
 def _parse_DER(der):
     """Parse a string containing DER encoded ASN.1 data
 
     return tuple of tuples, integers, strings.
     """
+    der = memoryview(der)
     i = 0
     r = ()
     while i < len(der):
-        tag = struct.unpack('B', der[i:i+1])[0]
+        tag = der[i]
         i += 1
-        l1 = struct.unpack('B', der[i:i+1])[0]
+        l1 = der[i]
         l2 = l1 & 0x7f
         i += 1
         if l1 & 0x80 != 0:
-            l = bytes_to_int(struct.unpack('{}B'.format(l2), der[i:i+l2]),
-                             'big')
+            l = int.from_bytes(der[i:i+l2], 'big')
             i += l2
         else:
             l = l2
         if tag == 0x2:
-            r += (bytes_to_int(struct.unpack('{}B'.format(l), der[i:i+l]),
-                               'big'), )
+            r += (int.from_bytes(der[i:i+l], 'big'), )
         elif tag == 0x3:
             r += (_parse_DER(der[i+1:i+l]), )
         elif tag == 0x5:
@@ -84,7 +150,7 @@ def _parse_DER(der):
         elif tag == 0x30:
             r += (_parse_DER(der[i:i+l]), )
         else:
-            r += (der[i:i+l], )
+            r += (bytes(der[i:i+l]), )
         i += l
     return r
 
@@ -111,14 +177,13 @@ class PublicKey:
     def _from_file(cls, file, form):
         if form == 'bi':
             name = unpack_asciiz(file)
-            bikey_length, bikey_type, bikey_version, bikey_alg = struct.unpack(
-                '<IBB2xI', file.read(12))
+            bikey_length, bikey_type, bikey_version, bikey_alg = (
+                _BIKEY_HDR.unpack(file.read(12)))
             #ALG_ID:
             #http://msdn.microsoft.com/en-us/library/windows/desktop/aa375549(v=vs.85).aspx
-            magic = struct.unpack('4s', file.read(4))
-            bitlen, public_exponent = struct.unpack('<II', file.read(4 + 4))
-            modulus = bytes_to_int(struct.unpack('{0}B'.format(bitlen//8),
-                                                 file.read(bitlen//8)))
+            magic = file.read(4)
+            bitlen, public_exponent = _U32X2.unpack(file.read(4 + 4))
+            modulus = int.from_bytes(file.read(bitlen//8), 'little')
         elif form == 'der' or form == 'pem':
             if form == 'der':
                 b = file.read()
@@ -148,9 +213,7 @@ class PublicKey:
                                self.name, b'\0', self.bitlen//8 + 20, 6, 2,
                                0x2400, b'RSA1', self.bitlen,
                                self.public_exponent))
-        file.write(struct.pack('{}B'.format(self.bitlen//8),
-                               *int_to_bytes(self.modulus, self.bitlen//8,
-                                             'little')))
+        file.write(self.modulus.to_bytes(self.bitlen//8, 'little'))
 
     def dump(self):
         """Dump PublicKey values to console."""
@@ -190,18 +253,12 @@ class PrivateKey:
         if form == 'bi':
             public_key = PublicKey.from_file(file, form)
             bitlen = public_key.bitlen
-            prime1 = bytes_to_int(struct.unpack('{}B'.format(bitlen//16),
-                                                file.read(bitlen//16)))
-            prime2 = bytes_to_int(struct.unpack('{}B'.format(bitlen//16),
-                                                file.read(bitlen//16)))
-            exponent1 = bytes_to_int(struct.unpack('{}B'.format(bitlen//16),
-                                                   file.read(bitlen//16)))
-            exponent2 = bytes_to_int(struct.unpack('{}B'.format(bitlen//16),
-                                                   file.read(bitlen//16)))
-            coefficient = bytes_to_int(struct.unpack('{}B'.format(bitlen//16),
-                                                     file.read(bitlen//16)))
-            private_exponent = bytes_to_int(struct.unpack(
-                '{}B'.format(bitlen//8), file.read(bitlen//8)))
+            prime1 = int.from_bytes(file.read(bitlen//16), 'little')
+            prime2 = int.from_bytes(file.read(bitlen//16), 'little')
+            exponent1 = int.from_bytes(file.read(bitlen//16), 'little')
+            exponent2 = int.from_bytes(file.read(bitlen//16), 'little')
+            coefficient = int.from_bytes(file.read(bitlen//16), 'little')
+            private_exponent = int.from_bytes(file.read(bitlen//8), 'little')
         elif form == 'der' or form == 'pem':
             if form == 'der':
                 b = file.read()
@@ -244,27 +301,13 @@ class PrivateKey:
         file.write(struct.pack('<{}ssIBB2xI4sII'.format(len(pkey.name)),
                                pkey.name, b'\0', bitlen//16*9 + 20, 7, 2,
                                0x2400, b'RSA2', bitlen, pkey.public_exponent))
-        file.write(struct.pack('{}B'.format(bitlen//8),
-                               *int_to_bytes(pkey.modulus, bitlen//8,
-                                             'little')))
-        file.write(struct.pack('{}B'.format(bitlen//16),
-                               *int_to_bytes(self.prime1, bitlen//16,
-                                             'little')))
-        file.write(struct.pack('{}B'.format(bitlen//16),
-                               *int_to_bytes(self.prime2, bitlen//16,
-                                             'little')))
-        file.write(struct.pack('{}B'.format(bitlen//16),
-                               *int_to_bytes(self.exponent1, bitlen//16,
-                                             'little')))
-        file.write(struct.pack('{}B'.format(bitlen//16),
-                               *int_to_bytes(self.exponent2, bitlen//16,
-                                             'little')))
-        file.write(struct.pack('{}B'.format(bitlen//16),
-                               *int_to_bytes(self.coefficient, bitlen//16,
-                                             'little')))
-        file.write(struct.pack('{}B'.format(bitlen//8),
-                               *int_to_bytes(self.private_exponent, bitlen//8,
-                                             'little')))
+        file.write(pkey.modulus.to_bytes(bitlen//8, 'little'))
+        file.write(self.prime1.to_bytes(bitlen//16, 'little'))
+        file.write(self.prime2.to_bytes(bitlen//16, 'little'))
+        file.write(self.exponent1.to_bytes(bitlen//16, 'little'))
+        file.write(self.exponent2.to_bytes(bitlen//16, 'little'))
+        file.write(self.coefficient.to_bytes(bitlen//16, 'little'))
+        file.write(self.private_exponent.to_bytes(bitlen//8, 'little'))
 
     def dump(self):
         """Dump PrivateKey values to console."""
@@ -276,6 +319,11 @@ class PrivateKey:
         print("Exponent2       : {:#x}".format(self.exponent2))
         print("Coefficient     : {:#x}".format(self.coefficient))
 
+def _write_sig(file, sig, length):
+    """Write a length-prefixed little-endian signature value."""
+    file.write(_U32.pack(length))
+    file.write(sig.to_bytes(length, 'little'))
+
 class Bisign:
     """Bisign class"""
 
@@ -304,12 +352,12 @@ class Bisign:
     @classmethod
     def _from_file(cls, file):
         public_key = PublicKey.from_file(file)
-        len1 = struct.unpack('<I', file.read(4))[0]
-        sig1 = bytes_to_int(struct.unpack('{}B'.format(len1), file.read(len1)))
-        version, len2 = struct.unpack('<II', file.read(8))
-        sig2 = bytes_to_int(struct.unpack('{}B'.format(len2), file.read(len2)))
-        len3 = struct.unpack('<I', file.read(4))[0]
-        sig3 = bytes_to_int(struct.unpack('{}B'.format(len3), file.read(len3)))
+        len1 = _U32.unpack(file.read(4))[0]
+        sig1 = int.from_bytes(file.read(len1), 'little')
+        version, len2 = _U32X2.unpack(file.read(8))
+        sig2 = int.from_bytes(file.read(len2), 'little')
+        len3 = _U32.unpack(file.read(4))[0]
+        sig3 = int.from_bytes(file.read(len3), 'little')
         return cls(public_key, sig1, sig2, sig3, version)
 
     def export(self, file):
@@ -323,13 +371,10 @@ class Bisign:
     def _export(self, file):
         self.public_key.export(file)
         len123 = self.public_key.bitlen//8
-        file.write(struct.pack('<I{}B'.format(len123), len123,
-                               *int_to_bytes(self.sig1, len123, 'little')))
-        file.write(struct.pack('<I', self.version))
-        file.write(struct.pack('<I{}B'.format(len123), len123,
-                               *int_to_bytes(self.sig2, len123, 'little')))
-        file.write(struct.pack('<I{}B'.format(len123), len123,
-                               *int_to_bytes(self.sig3, len123, 'little')))
+        _write_sig(file, self.sig1, len123)
+        file.write(_U32.pack(self.version))
+        _write_sig(file, self.sig2, len123)
+        _write_sig(file, self.sig3, len123)
 
     def dump(self):
         """Dump Bisign values to console."""
@@ -353,20 +398,31 @@ class PboInfo:
         self.data_size = data_size
         self.fp = fp
         self.data_offset = -1
+        self._cached_size = None
+        self._cached_timestamp = None
+        self._ext = None
 
     def get_data_size(self):
         """Get the file size of the member."""
-        if self.fp is None:
-            return self.data_size
-        else:
-            return os.fstat(self.fp.fileno()).st_size
+        if self._cached_size is None:
+            if self.fp is None:
+                self._cached_size = self.data_size
+            elif isinstance(self.fp, str):
+                self._cached_size = os.stat(self.fp).st_size
+            else:
+                self._cached_size = os.fstat(self.fp.fileno()).st_size
+        return self._cached_size
 
     def get_timestamp(self):
         """Get the timestamp of the member."""
-        if self.fp is None:
-            return self.timestamp
-        else:
-            return long(os.path.getmtime(self.fp.name))
+        if self._cached_timestamp is None:
+            if self.fp is None:
+                self._cached_timestamp = self.timestamp
+            elif isinstance(self.fp, str):
+                self._cached_timestamp = long(os.path.getmtime(self.fp))
+            else:
+                self._cached_timestamp = long(os.path.getmtime(self.fp.name))
+        return self._cached_timestamp
 
     def check_name_hash(self):
         """Check whether member name needs to be hashed."""
@@ -374,17 +430,15 @@ class PboInfo:
 
     def check_file_hash(self, version):
         """Check whether member file needs to be hashed."""
+        if self._ext is None:
+            name = self.filename.lower()
+            i = name.rfind(b'.')
+            self._ext = name[i:] if i >= 0 else b''
         if version == 2:
             return (self.get_data_size() > 0 and
-                    not self.filename.lower().endswith((
-                        b'.paa', b'.jpg', b'.p3d', b'.tga', b'.rvmat', b'.lip',
-                        b'.ogg', b'.wss', b'.png', b'.rtm', b'.pac', b'.fxy',
-                        b'.wrp')))
+                    self._ext not in NO_HASH_EXT_V2)
         elif version == 3:
-            return (self.get_data_size() > 0 and
-                    self.filename.lower().endswith((
-                        b'.sqf', b'.inc', b'.bikb', b'.ext', b'.fsm', b'.sqm',
-                        b'.hpp', b'.cfg', b'.sqs', b'.h')))
+            return self.get_data_size() > 0 and self._ext in HASH_EXT_V3
         else:
             raise ValueError("Unknown signature version {}".format(version))
 
@@ -445,6 +499,31 @@ class PboExtFile:
         """Tell within PboExtFile."""
         return self.pos - self.info.data_offset
 
+def _fastcopy(src, dst):
+    """Copy src to dst, zero-copy via sendfile when both are real files."""
+    if isinstance(src, PboExtFile) and hasattr(os, 'sendfile'):
+        try:
+            in_fd = src.fp.fileno()
+            out_fd = dst.fileno()
+        except (AttributeError, OSError):
+            in_fd = None
+        if in_fd is not None:
+            start = offset = src.pos
+            end = src.info.data_offset + src.info.data_size
+            dst.flush()
+            try:
+                while offset < end:
+                    sent = os.sendfile(out_fd, in_fd, offset, end - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+                src.pos = offset
+                return
+            except OSError:
+                if offset != start:
+                    raise
+    shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
 class PboFile:
     """PBO file class"""
 
@@ -462,6 +541,7 @@ class PboFile:
             self.filedict = filedict
         self.filename = filename
         self.fp = fp
+        self.mm = None
 
     @classmethod
     def from_file(cls, file):
@@ -475,53 +555,130 @@ class PboFile:
         else:
             fp = file
             filename = file.name
-        #header = unpack_asciiz(fp), *struct.unpack('<IIIII', fp.read(20))
-        header = (unpack_asciiz(fp),) + struct.unpack('<IIIII', fp.read(20))
-        header_extension = OrderedDict()
-        s = unpack_asciiz(fp)
-        while len(s) != 0:
-            header_extension[s] = unpack_asciiz(fp)
+        try:
+            mm = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            mm = None
+        if mm is not None:
+            header, ext_items, entries, data_offset = parse_pbo_header(mm)
+            header_extension = OrderedDict(ext_items)
+            if verbose > 3:
+                print("Reading PBOinfos")
+            for entry in entries:
+                filedict[entry[0]] = PboInfo(*entry)
+            fp.seek(data_offset)
+        else:
+            #header = unpack_asciiz(fp), *_PBO_ENTRY.unpack(fp.read(20))
+            header = (unpack_asciiz(fp),) + _PBO_ENTRY.unpack(fp.read(20))
+            header_extension = OrderedDict()
             s = unpack_asciiz(fp)
-        s = unpack_asciiz(fp)
-        if verbose > 3:
-            print("Reading PBOinfos")
-        while len(s) != 0:
-            filedict[s] = PboInfo(s, *struct.unpack('<IIIII', fp.read(20)))
+            while len(s) != 0:
+                header_extension[s] = unpack_asciiz(fp)
+                s = unpack_asciiz(fp)
             s = unpack_asciiz(fp)
-        empty = fp.read(20)
-        data_offset = fp.tell()
+            if verbose > 3:
+                print("Reading PBOinfos")
+            while len(s) != 0:
+                filedict[s] = PboInfo(s, *_PBO_ENTRY.unpack(fp.read(20)))
+                s = unpack_asciiz(fp)
+            empty = fp.read(20)
+            data_offset = fp.tell()
         for info in filedict.values():
             info.data_offset = data_offset
             data_offset += info.data_size
         if verbose > 3:
             print("Done")
-        return cls(header, header_extension, filedict, filename=filename,
-                   fp=fp)
+        pbofile = cls(header, header_extension, filedict, filename=filename,
+                      fp=fp)
+        pbofile.mm = mm
+        return pbofile
 
     def export(self, file):
         """Export PboFile to file."""
         if isinstance(file, str):
-            with open(file, 'wb') as f:
+            #readable so _export can map the output for the final hash
+            with open(file, 'w+b') as f:
                 self._export(f)
         else:
             self._export(file)
 
+    def _writable_mappable_fd(self, file):
+        """Return file's fd when it can take raw writes and be mapped."""
+        if not hasattr(os, 'sendfile') or fcntl is None:
+            return None
+        try:
+            if not file.seekable():
+                return None
+            fd = file.fileno()
+        except (AttributeError, OSError):
+            return None
+        if fcntl.fcntl(fd, fcntl.F_GETFL) & os.O_ACCMODE == os.O_WRONLY:
+            return None
+        return fd
+
+    def _copy_member(self, out_fd, info):
+        """Copy one member's data to out_fd, zero-copy where possible."""
+        if info.fp is None and self.mm is not None:
+            a = info.data_offset
+            os.write(out_fd, memoryview(self.mm)[a:a + info.data_size])
+            return
+        with self.open(info) as f:
+            try:
+                in_fd = f.fileno()
+            except (AttributeError, OSError):
+                in_fd = None
+            if in_fd is not None:
+                size = info.get_data_size()
+                offset = start = f.tell()
+                try:
+                    while offset < size:
+                        sent = os.sendfile(out_fd, in_fd, offset,
+                                           size - offset)
+                        if sent == 0:
+                            break
+                        offset += sent
+                    return
+                except OSError:
+                    if offset != start:
+                        raise
+            data = f.read(CHUNK_SIZE)
+            while len(data) > 0:
+                os.write(out_fd, data)
+                data = f.read(CHUNK_SIZE)
+
     def _export(self, file):
-        hash1 = hashlib.sha1()
-        header = struct.pack('<sIIIII', *self.header)
+        sorted_items = sorted(self.filedict.items())
+        parts = [struct.pack('s', self.header[0]),
+                 _PBO_ENTRY.pack(*self.header[1:])]
         for k, v in self.header_extension.items():
-            header += struct.pack('{}ss{}ss'.format(len(k), len(v)), k, b'\0',
-                                  v, b'\0')
-        header += struct.pack('s', b'\0')
-        for k, v in sorted(self.filedict.items()):
-            header += struct.pack('<{}ssIIIII'.format(len(v.filename)),
-                                  v.filename, b'\0', v.packing_method,
-                                  v.original_size, v.reserved,
-                                  v.get_timestamp(), v.get_data_size())
-        header += struct.pack('<21s', b'\0'*21)
+            parts += (k, b'\0', v, b'\0')
+        parts.append(b'\0')
+        for k, v in sorted_items:
+            parts += (v.filename, b'\0',
+                      _PBO_ENTRY.pack(v.packing_method, v.original_size,
+                                      v.reserved, v.get_timestamp(),
+                                      v.get_data_size()))
+        parts.append(b'\0'*21)
+        header = b''.join(parts)
+        out_fd = self._writable_mappable_fd(file)
+        if out_fd is not None:
+            file.write(header)
+            file.flush()
+            for k, v in sorted_items:
+                self._copy_member(out_fd, v)
+            size = os.lseek(out_fd, 0, os.SEEK_CUR)
+            hash1 = hashlib.sha1()
+            with mmap.mmap(out_fd, size, access=mmap.ACCESS_READ) as out_mm:
+                hash1.update(memoryview(out_mm)[:size])
+            if verbose > 3:
+                print(hash1.hexdigest())
+            os.write(out_fd, b'\0' + hash1.digest())
+            file.seek(0, 2)
+            return
+        hash1 = hashlib.sha1()
         hash1.update(header)
         file.write(header)
-        for k, v in sorted(self.filedict.items()):
+        for k, v in sorted_items:
             with self.open(v) as f:
                 data = f.read(CHUNK_SIZE)
                 while len(data) > 0:
@@ -530,12 +687,14 @@ class PboFile:
                     data = f.read(CHUNK_SIZE)
         if verbose > 3:
             print(hash1.hexdigest())
-        file.write(struct.pack('<s20B', b'\0',
-                               *int_to_bytes(long(hash1.hexdigest(), 16), 20,
-                                             'big')))
+        file.write(b'\0' + hash1.digest())
 
     def add(self, name, file):
-        """Add a file to the PboFile."""
+        """Add a file to the PboFile.
+
+        file may be an open file object or a path; a path is opened
+        lazily on export, keeping one descriptor in use at a time.
+        """
         dst_name = name.replace(os.path.sep, '\\')
         if dst_name.encode() in self.filedict:
             raise KeyError("{0} exists in PBO".format(dst_name))
@@ -558,7 +717,14 @@ class PboFile:
             raise KeyError("{0} not found in PBO".format(name))
 
     def close(self):
-        """Close the file handle."""
+        """Close the file handle and any added member files."""
+        for info in self.filedict.values():
+            if info.fp is not None and not isinstance(info.fp, str):
+                info.fp.close()
+                info.fp = None
+        if self.mm is not None:
+            self.mm.close()
+            self.mm = None
         if self.fp is not None:
             self.fp.close()
     def __enter__(self):
@@ -568,6 +734,10 @@ class PboFile:
     def __del__(self):
         self.close()
 
+    def __iter__(self):
+        """Iterate over members without building an infolist() copy."""
+        return iter(self.filedict.values())
+
     def namelist(self):
         """Return member names as list of strings."""
         return list(self.filedict.keys())
@@ -584,29 +754,41 @@ class PboFile:
             pboinfo = self.getinfo(name)
         if pboinfo.fp is None:
             return PboExtFile(self.fp, pboinfo, mode)
+        elif isinstance(pboinfo.fp, str):
+            return open(pboinfo.fp, mode)
         else:
             return pboinfo.fp
 
     def _namehash(self):
         """Create hash from member names."""
         namehash = hashlib.sha1()
-        for info in sorted(self.infolist(), key=lambda v: v.filename.lower()):
+        lowered = [(info.filename.lower(), info) for info in self.infolist()]
+        lowered.sort(key=lambda t: t[0])
+        for lname, info in lowered:
             if info.check_name_hash():
-                namehash.update(info.filename.lower())
+                namehash.update(lname)
         return namehash
 
     def _filehash(self, version):
         """Create hash from member data."""
         filehash = hashlib.sha1()
         nothing = True
+        mv = memoryview(self.mm) if self.mm is not None else None
         for info in self.infolist():
             if info.check_file_hash(version):
                 nothing = False
-                with self.open(info) as file:
-                    rlen = info.data_size
-                    while rlen > 0:
-                        filehash.update(file.read(min(CHUNK_SIZE, rlen)))
-                        rlen = info.data_size - file.tell()
+                if mv is not None and info.fp is None:
+                    filehash.update(mv[info.data_offset:
+                                       info.data_offset + info.data_size])
+                else:
+                    with self.open(info) as file:
+                        rlen = info.data_size
+                        while rlen > 0:
+                            data = file.read(min(CHUNK_SIZE, rlen))
+                            if len(data) == 0:
+                                break
+                            filehash.update(data)
+                            rlen -= len(data)
         if nothing:
             if version == 2:
                 filehash.update(b'nothing')
@@ -622,25 +804,73 @@ class PboFile:
             print("Calculating hash1:")
         if file is None:
             file = self.fp
-        oldpos = file.tell()
-        file.seek(-21, 2)
-        end = file.tell()
-        file.seek(0)
         hash1 = hashlib.sha1()
-        rlen = end
-        while rlen > 0:
-            hash1.update(file.read(min(CHUNK_SIZE, rlen)))
-            rlen = end - file.tell()
-        file.seek(oldpos)
+        if self.mm is not None and file is self.fp:
+            hash1.update(memoryview(self.mm)[:len(self.mm) - 21])
+        else:
+            oldpos = file.tell()
+            file.seek(-21, 2)
+            end = file.tell()
+            file.seek(0)
+            rlen = end
+            while rlen > 0:
+                data = file.read(min(CHUNK_SIZE, rlen))
+                if len(data) == 0:
+                    break
+                hash1.update(data)
+                rlen -= len(data)
+            file.seek(oldpos)
         if verbose > 3:
             print(hash1.hexdigest())
         return hash1
 
+    def _fused_hash(self, version):
+        """Calculate hash1 and the file hash in one pass over the map."""
+        hash1 = hashlib.sha1()
+        filehash = hashlib.sha1()
+        nothing = True
+        mv = memoryview(self.mm)
+        end = len(self.mm) - 21
+        pos = 0
+        for info in self.filedict.values():
+            a = info.data_offset
+            b = a + info.data_size
+            if a > pos:
+                hash1.update(mv[pos:a])
+            hash1.update(mv[a:b])
+            pos = b
+            if info.check_file_hash(version):
+                nothing = False
+                filehash.update(mv[a:b])
+        if pos < end:
+            hash1.update(mv[pos:end])
+        if nothing:
+            if version == 2:
+                filehash.update(b'nothing')
+            elif version == 3:
+                filehash.update(b'gnihton')
+            else:
+                raise ValueError("Unknown signature version {}".format(version))
+        return hash1, filehash
+
     def hash(self, file=None, version=3):
         """Calculate all 3 hash values."""
         if file is None:
             file = self.fp
-        hash1 = self.hash1(file)
+        if self.mm is not None and file is self.fp:
+            if all(info.fp is None for info in self.filedict.values()):
+                hash1, filehash = self._fused_hash(version)
+            else:
+                #hash1 runs over the map and _filehash over the loose
+                #member files, so the two sha1 loops never share a file
+                #handle and libssl drops the GIL while hashing
+                with concurrent.futures.ThreadPoolExecutor(2) as executor:
+                    hash1_future = executor.submit(self.hash1, file)
+                    filehash = self._filehash(version)
+                    hash1 = hash1_future.result()
+        else:
+            hash1 = self.hash1(file)
+            filehash = self._filehash(version)
         namehash = self._namehash()
         if verbose > 3:
             print("Calculating hash2:")
@@ -651,7 +881,6 @@ class PboFile:
             hash2.update(self.header_extension[b'prefix'] + b'\\')
         if verbose > 3:
             print(hash2.hexdigest())
-        filehash = self._filehash(version)
         if verbose > 3:
             print("Calculating hash3:")
         hash3 = hashlib.sha1()
@@ -666,21 +895,49 @@ class PboFile:
 def _sign(args):
     sign(args.key, args.pbo, args.keyform, args.version)
 
-def sign(key_path, pbo_path, keyform='bi', version=3):
-    """Create signature file for private key & PBO."""
-    pkey = PrivateKey.from_file(key_path, keyform)
+_key_cache = {}
+
+def _load_private_key(key_path, keyform):
+    """Load a PrivateKey, cached by path, mtime and form."""
+    if not isinstance(key_path, str):
+        return PrivateKey.from_file(key_path, keyform)
+    cache_key = (key_path, os.path.getmtime(key_path), keyform)
+    pkey = _key_cache.get(cache_key)
+    if pkey is None:
+        pkey = PrivateKey.from_file(key_path, keyform)
+        _key_cache[cache_key] = pkey
+    return pkey
+
+def _crt_sign(m, p, q, dp, dq, qinv):
+    """RSA signature of m using the Chinese remainder theorem."""
+    m1 = powmod(m % p, dp, p)
+    m2 = powmod(m % q, dq, q)
+    h = (qinv * (m1 - m2)) % p
+    return m2 + h * q
+
+def _sign_pbo(pkey, pbo_path, version):
+    """Create signature file for an already loaded private key & PBO."""
     with PboFile.from_file(pbo_path) as p:
         hash1, hash2, hash3 = p.hash(None, version)
     if verbose > 1:
         print("hash1: 0x" + hash1.hexdigest())
         print("hash2: 0x" + hash2.hexdigest())
         print("hash3: 0x" + hash3.hexdigest())
-    sig1 = pow(padding(hash1.hexdigest(), pkey.public_key.bitlen//8),
-               pkey.private_exponent, pkey.public_key.modulus)
-    sig2 = pow(padding(hash2.hexdigest(), pkey.public_key.bitlen//8),
-               pkey.private_exponent, pkey.public_key.modulus)
-    sig3 = pow(padding(hash3.hexdigest(), pkey.public_key.bitlen//8),
-               pkey.private_exponent, pkey.public_key.modulus)
+    tlen = pkey.public_key.bitlen//8
+    if pkey.prime1 and pkey.prime2 and pkey.coefficient:
+        #signing mod p and q separately is ~4x faster than mod n
+        p1, p2 = mpz(pkey.prime1), mpz(pkey.prime2)
+        dp, dq = mpz(pkey.exponent1), mpz(pkey.exponent2)
+        qinv = mpz(pkey.coefficient)
+        sig1, sig2, sig3 = (
+            int(_crt_sign(mpz(padding(h.digest(), tlen)), p1, p2, dp, dq,
+                          qinv))
+            for h in (hash1, hash2, hash3))
+    else:
+        d = mpz(pkey.private_exponent)
+        n = mpz(pkey.public_key.modulus)
+        sig1, sig2, sig3 = (int(powmod(mpz(padding(h.digest(), tlen)), d, n))
+                            for h in (hash1, hash2, hash3))
     bsign = Bisign(pkey, sig1, sig2, sig3, version)
     if verbose > 0:
         print("sig1: {:x}".format(sig1))
@@ -688,10 +945,23 @@ def sign(key_path, pbo_path, keyform='bi', version=3):
         print("sig3: {:x}".format(sig3))
     bsign.export('{:s}.{:s}.bisign'.format(os.path.basename(pbo_path),
                                            pkey.public_key.name.decode()))
+
+def sign(key_path, pbo_path, keyform='bi', version=3):
+    """Create signature file for private key & PBO."""
+    pkey = _load_private_key(key_path, keyform)
+    _sign_pbo(pkey, pbo_path, version)
     if not quiet:
         print("Signature created")
     sys.exit(0)
 
+def sign_many(key_path, pbo_paths, keyform='bi', version=3):
+    """Create signature files for several PBOs with the same key."""
+    pkey = _load_private_key(key_path, keyform)
+    for pbo_path in pbo_paths:
+        _sign_pbo(pkey, pbo_path, version)
+    if not quiet:
+        print("Signatures created")
+
 def _verify(args):
     verify(args.key, args.pbo, args.sig, args.keyform, args.privin)
 
@@ -704,18 +974,14 @@ def verify(key_path, pbo_path, sig_path, keyform='bi', privin=False):
     bsign = Bisign.from_file(sig_path)
     with PboFile.from_file(pbo_path) as p:
         hash1, hash2, hash3 = p.hash(None, bsign.version)
-    verify1 = (padding(hash1.hexdigest(),
-                       pkey.bitlen//8)) == pow(bsign.sig1,
-                                               pkey.public_exponent,
-                                               pkey.modulus)
-    verify2 = (padding(hash2.hexdigest(),
-                       pkey.bitlen//8)) == pow(bsign.sig2,
-                                               pkey.public_exponent,
-                                               pkey.modulus)
-    verify3 = (padding(hash3.hexdigest(),
-                       pkey.bitlen//8)) == pow(bsign.sig3,
-                                               pkey.public_exponent,
-                                               pkey.modulus)
+    e = mpz(pkey.public_exponent)
+    n = mpz(pkey.modulus)
+    verify1 = (padding(hash1.digest(),
+                       pkey.bitlen//8)) == powmod(mpz(bsign.sig1), e, n)
+    verify2 = (padding(hash2.digest(),
+                       pkey.bitlen//8)) == powmod(mpz(bsign.sig2), e, n)
+    verify3 = (padding(hash3.digest(),
+                       pkey.bitlen//8)) == powmod(mpz(bsign.sig3), e, n)
     if verbose > 0:
         print("sig1: {}".format(verify1))
         print("sig2: {}".format(verify2))
@@ -774,31 +1040,33 @@ def pbo(pbo_path, include="*", exclude="", create_pbo=False,
     if create_pbo:
         pbo_dir = os.path.dirname(pbo_path)
         tmpfile = tempfile.mkstemp(dir=pbo_dir)
-        os.close(tmpfile[0])
+        pred = _make_filter(include, exclude)
         with PboFile() as p:
             for f in files:
                 if os.path.isfile(f):
                     if pboprefixfile and (f == '$PBOPREFIX$'):
                         with open(f, 'r') as fp:
                             p.header_extension[b'prefix'] = fp.readline().rstrip().encode()
-                    else:
-                        if (fnmatch.fnmatch(f.lower(), include.lower()) and not
-                                fnmatch.fnmatch(f.lower(), exclude.lower())):
-                            p.add(f, open(f, 'rb'))
+                    elif pred is None or pred(f.lower()):
+                        p.add(f, f)
                 elif recursion and os.path.isdir(f):
-                    files.extend([os.path.join(f, fn) for fn in files(f)])
+                    for root, dirs, names in os.walk(f):
+                        files.extend(os.path.join(root, n) for n in names)
             for k, v in header_extension:
                 p.header_extension[k.encode()] = v.encode()
-            with open(tmpfile[1], 'wb') as t:
+            with os.fdopen(tmpfile[0], 'w+b', buffering=CHUNK_SIZE) as t:
                 p.export(t)
-        os.rename(tmpfile[1], pbo_path)
+        os.replace(tmpfile[1], pbo_path)
     else:
+        pred = _make_filter(include, exclude, binary=True)
         with PboFile.from_file(pbo_path) as p:
+            infos = p.infolist()
+            if not infos and not p.header_extension:
+                return
             if list_pbo:
-                for name in p.namelist():
-                    if (fnmatch.fnmatch(name.decode().lower(), include.lower())
-                            and not fnmatch.fnmatch(name.decode().lower(),
-                                                    exclude.lower())):
+                for info in infos:
+                    name = info.filename
+                    if pred is None or pred(name.lower()):
                         print(name.decode())
             elif extract_pbo:
                 pbo_d = pbo_path.replace(".pbo","")
@@ -807,24 +1075,30 @@ def pbo(pbo_path, include="*", exclude="", create_pbo=False,
                 if pboprefixfile and (b'prefix' in p.header_extension):
                     with open('$PBOPREFIX$', 'w') as f:
                         f.write(p.header_extension[b'prefix'].decode())
-                for info in p.infolist():
-                    if (fnmatch.fnmatch(info.filename.decode().lower(),
-                                        include.lower()) and not
-                            fnmatch.fnmatch(info.filename.decode().lower(),
-                                            exclude.lower())):
-                        with p.open(info) as src:
-                            print(src.name.decode())
-                            dst_name = pbo_d+'\\'+src.name.decode().replace('\\',os.path.sep)
-                            dst_dir = os.path.dirname(dst_name)
-                            print(type(dst_dir))
-                            if not (os.path.exists(dst_dir) or dst_dir == ''):
-                                os.makedirs(dst_dir)
-                            with open(dst_name, 'wb') as dst:
-                                shutil.copyfileobj(src, dst)
-
+                created_dirs = set()
+                sep = os.path.sep
+                names_out = []
+                matches = infos if pred is None else \
+                    [info for info in infos
+                     if pred(info.filename.lower())]
+                for info in matches:
+                    with p.open(info) as src:
+                        if not quiet:
+                            names_out.append(src.name + b'\n')
+                        dst_name = os.path.join(
+                            pbo_d, src.name.decode().replace('\\', sep))
+                        dst_dir = os.path.dirname(dst_name)
+                        if dst_dir and dst_dir not in created_dirs:
+                            os.makedirs(dst_dir, exist_ok=True)
+                            created_dirs.add(dst_dir)
+                        with open(dst_name, 'wb') as dst:
+                            _fastcopy(src, dst)
+                if names_out:
+                    sys.stdout.buffer.write(b''.join(names_out))
+                    sys.stdout.flush()
             elif info_pbo:
                 if len(p.header_extension) > 0:
-                    width = max(len(k) for k in p.header_extension.keys())
+                    width = max(map(len, p.header_extension))
                     print('Header extensions:')
                     print(18*'-')
                     for k, v in p.header_extension.items():
@@ -837,7 +1111,43 @@ def pbo(pbo_path, include="*", exclude="", create_pbo=False,
 # Созданные функции специально для AoR #
 ########################################
 
-def open_pbo(pbo_path, pboprefixfile = True, include="*", exclude="", delete_pbo = False):
+@functools.lru_cache(maxsize=256)
+def _compile_glob(pat, binary=False):
+    """Compile a glob pattern, cached per unique pattern."""
+    translated = fnmatch.translate(pat.lower())
+    return re.compile(translated.encode() if binary else translated)
+
+def _make_filter(include, exclude, binary=False):
+    """Build a lowercase-name predicate from include/exclude globs.
+
+    Returns None for the default patterns, which match every name, so
+    callers can skip the check entirely. With binary=True the regexes
+    operate on bytes, letting member names be matched without decoding.
+    """
+    if include in ("", "*") and not exclude:
+        return None
+    inc_re = _compile_glob(include, binary)
+    if not exclude:
+        return inc_re.match
+    exc_re = _compile_glob(exclude, binary)
+    def pred(name):
+        return inc_re.match(name) and not exc_re.match(name)
+    return pred
+
+def _extract_one(p, info, dst_name, lock):
+    """Extract one PBO member to dst_name."""
+    with open(dst_name, 'wb') as dst:
+        if p.mm is not None and info.fp is None:
+            dst.write(memoryview(p.mm)[info.data_offset:
+                                       info.data_offset + info.data_size])
+        else:
+            #PboExtFile seeks the shared file handle, serialize those reads
+            with lock:
+                with p.open(info) as src:
+                    _fastcopy(src, dst)
+
+def open_pbo(pbo_path, pboprefixfile = True, include="*", exclude="", delete_pbo = False, max_workers = 8):
+    pred = _make_filter(include, exclude, binary=True)
     with PboFile.from_file(pbo_path) as p:
         pbo_d = pbo_path.replace(".pbo","")
         if not (os.path.exists(pbo_d) or pbo_d == ''):
@@ -845,37 +1155,50 @@ def open_pbo(pbo_path, pboprefixfile = True, include="*", exclude="", delete_pbo
         if pboprefixfile and (b'prefix' in p.header_extension):
             with open('$PBOPREFIX$', 'w') as f:
                         f.write(p.header_extension[b'prefix'].decode())
-        for info in p.infolist():
-            if (fnmatch.fnmatch(info.filename.decode().lower(),include.lower()) and not fnmatch.fnmatch(info.filename.decode().lower(),exclude.lower())):
-                with p.open(info) as src:
-                    dst_name = pbo_d+'\\'+src.name.decode().replace('\\',os.path.sep)
-                    dst_dir = os.path.dirname(dst_name)
-                    if not (os.path.exists(dst_dir) or dst_dir == ''):
-                        os.makedirs(dst_dir)
-                    with open(dst_name, 'wb') as dst:
-                        shutil.copyfileobj(src, dst)
+        created_dirs = set()
+        jobs = []
+        sep = os.path.sep
+        matches = p if pred is None else \
+            [info for info in p if pred(info.filename.lower())]
+        for info in matches:
+            dst_name = os.path.join(
+                pbo_d, info.filename.decode().replace('\\', sep))
+            dst_dir = os.path.dirname(dst_name)
+            if dst_dir and dst_dir not in created_dirs:
+                os.makedirs(dst_dir, exist_ok=True)
+                created_dirs.add(dst_dir)
+            jobs.append((info, dst_name))
+        lock = threading.Lock()
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            futures = [executor.submit(_extract_one, p, info, dst_name, lock)
+                       for info, dst_name in jobs]
+            for future in futures:
+                future.result()
     if delete_pbo:
         os.remove(pbo_path)
                         
 def create_pbo(pbo_path,pboprefixfile=True,include="*", exclude="",delete_path = False):
-    files = os.listdir(pbo_path)
     pbo_dir = os.path.dirname(pbo_path)
     tmpfile = tempfile.mkstemp(dir=pbo_dir)
-    os.close(tmpfile[0])
+    pred = _make_filter(include, exclude)
+    #walk first so the directory reads happen in one burst, then add
+    all_files = []
+    for root, dirs, names in os.walk(pbo_path):
+        rel_root = os.path.relpath(root, pbo_path)
+        for f in names:
+            full = os.path.join(root, f)
+            rel = f if rel_root == '.' else os.path.join(rel_root, f)
+            all_files.append((rel, full))
     with PboFile() as p:
-        for f in files:
-            if os.path.isfile(f"{pbo_path}\\{f}"):
-                if pboprefixfile and (f"{pbo_path}\\{f}" == '$PBOPREFIX$'):
-                    with open(f"{pbo_path}\\{f}", 'r') as fp:
-                        p.header_extension[b'prefix'] = fp.readline().rstrip().encode()
-                else:
-                    if (fnmatch.fnmatch(f"{pbo_path}\\{f}".lower(), include.lower()) and not fnmatch.fnmatch(f"{pbo_path}\\{f}".lower(), exclude.lower())):
-                        p.add(f, open(f"{pbo_path}\\{f}", 'rb'))
-            elif os.path.isdir(f"{pbo_path}\\{f}"):
-                files.extend([os.path.join(f, fn) for fn in os.listdir(f"{pbo_path}\\{f}")])
-        with open(tmpfile[1], 'wb') as t:
+        for rel, full in all_files:
+            if pboprefixfile and rel == '$PBOPREFIX$':
+                with open(full, 'r') as fp:
+                    p.header_extension[b'prefix'] = fp.readline().rstrip().encode()
+            elif pred is None or pred(full.lower()):
+                p.add(rel, full)
+        with os.fdopen(tmpfile[0], 'w+b', buffering=CHUNK_SIZE) as t:
                 p.export(t)
     if delete_path:
         shutil.rmtree(pbo_path)
-    os.rename(tmpfile[1], f"{pbo_path}.pbo")
+    os.replace(tmpfile[1], f"{pbo_path}.pbo")
     
\ No newline at end of file